@@ -20,20 +20,45 @@ Example usage:
         --year=VOC2012  --output_path=/tmp/pascal
 """
 
+import contextlib
 import hashlib
-import io
+import heapq
 import json
+import multiprocessing
 import os
+import shutil
+import tempfile
 
 from absl import app
 from absl import flags
 from absl import logging
 
-from lxml import etree
-import PIL.Image
+import numpy as np
 import tensorflow as tf
 
-from dataset import tfrecord_util
+try:
+    import orjson  # pylint: disable=g-import-not-at-top
+
+    def _loads(data):
+        return orjson.loads(data)
+
+    def _dumps(obj):
+        return orjson.dumps(obj)
+except ImportError:
+    # Fall back to the (slower) standard library parser.
+    def _loads(data):
+        return json.loads(data)
+
+    def _dumps(obj):
+        return json.dumps(obj).encode('utf8')
+
+# Hashes available for the image/key/<hash> feature.
+_IMAGE_KEY_HASHES = {'sha256': hashlib.sha256}
+try:
+    from blake3 import blake3  # pylint: disable=g-import-not-at-top
+    _IMAGE_KEY_HASHES['blake3'] = blake3
+except ImportError:
+    pass
 
 flags.DEFINE_string('data_dir', '', 'Root directory to raw synth DR data.')
 flags.DEFINE_string('set', 'train', 'Convert training set, validation set or '
@@ -48,8 +73,17 @@ flags.DEFINE_string('camera_settings_json_path', None,
                     'Path to camera settings json file with a dictionary.')
 flags.DEFINE_boolean('ignore_difficult_instances', False, 'Whether to ignore '
                                                           'difficult instances')
+flags.DEFINE_enum('image_key_hash', 'sha256', ['sha256', 'blake3'],
+                  'Hash stored as the image/key/<hash> feature. blake3 is '
+                  'faster but needs the blake3 package.')
 flags.DEFINE_integer('num_shards', 1, 'Number of shards for output file.')
 flags.DEFINE_integer('num_images', None, 'Max number of imags to process.')
+flags.DEFINE_integer('num_threads', None, 'Number of processes to run.')
+flags.DEFINE_enum('compression_type', '', ['', 'GZIP', 'ZLIB'],
+                  'Compression for the output TFRecords. Readers must use the '
+                  'same compression_type in tf.data.TFRecordDataset.')
+flags.DEFINE_integer('compression_level', 1,
+                     'zlib compression level used with --compression_type.')
 FLAGS = flags.FLAGS
 
 SETS = ['train', 'val', 'trainval', 'test']
@@ -67,6 +101,10 @@ esm_label_map_dict = {
     'Body': 8,
 }
 
+_FRONTAL = b'Frontal'
+_JPEG = b'jpeg'
+_JPEG_SOI = b'\xff\xd8\xff'  # JPEG start-of-image marker.
+
 GLOBAL_IMG_ID = 0  # global image id.
 GLOBAL_ANN_ID = 0  # global annotation id.
 
@@ -92,14 +130,109 @@ def get_ann_id():
     return GLOBAL_ANN_ID
 
 
+def read_file(path):
+    """Returns the contents of path as bytes.
+
+    Any path with a filesystem scheme ('gs://', 'file://', 'ram://', ...) goes
+    through tf.io.gfile; plain local paths are read with the builtin open(),
+    which avoids the GFile wrapper overhead per file.
+    """
+    if '://' in path:
+        with tf.io.gfile.GFile(path, 'rb') as f:
+            return f.read()
+    with open(path, 'rb', buffering=0) as f:
+        return f.read()
+
+
+def _set_int64_list(feature, value):
+    # SetInParent() marks the list as set even when value is empty.
+    feature.int64_list.SetInParent()
+    feature.int64_list.value.extend(value)
+
+
+def _set_bytes_list(feature, value):
+    feature.bytes_list.SetInParent()
+    feature.bytes_list.value.extend(value)
+
+
+def _set_float_list(feature, value):
+    feature.float_list.SetInParent()
+    feature.float_list.value.extend(value)
+
+
+class CocoJsonWriter(object):
+    """Streams COCO instances json to disk as images are converted.
+
+    Images are written straight to a temporary file next to path; annotations
+    are spooled to a local temporary file and appended on close(), so neither
+    list has to be kept in memory. The json only appears at path once close()
+    succeeds; used as a context manager, an exception discards it instead.
+    """
+
+    def __init__(self, path, categories):
+        self._path = path
+        self._tmp_path = path + '.incomplete'
+        self._f = tf.io.gfile.GFile(self._tmp_path, 'wb')
+        self._ann_f = tempfile.TemporaryFile()
+        self._first_image = True
+        self._first_ann = True
+        self._f.write(b'{"type":"instances","categories":')
+        self._f.write(_dumps(categories))
+        self._f.write(b',"images":[')
+
+    def add_image(self, image):
+        if not self._first_image:
+            self._f.write(b',')
+        self._first_image = False
+        self._f.write(_dumps(image))
+
+    def add_annotation(self, ann):
+        if not self._first_ann:
+            self._ann_f.write(b',')
+        self._first_ann = False
+        self._ann_f.write(_dumps(ann))
+
+    def close(self):
+        """Finishes the json and moves it to its final path."""
+        try:
+            self._f.write(b'],"annotations":[')
+            self._ann_f.seek(0)
+            shutil.copyfileobj(self._ann_f, self._f)
+            self._f.write(b']}')
+            self._f.close()
+        except BaseException:
+            self.abort()
+            raise
+        self._ann_f.close()
+        tf.io.gfile.rename(self._tmp_path, self._path, overwrite=True)
+
+    def abort(self):
+        """Closes all files and removes the partially written json."""
+        self._ann_f.close()
+        self._f.close()
+        if tf.io.gfile.exists(self._tmp_path):
+            tf.io.gfile.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
 def dict_to_tf_example(data,
                        dataset_directory,
                        filepath,
+                       image_id,
                        camera_settings,
                        label_map_dict,
                        ignore_difficult_instances=False,
                        image_subdirectory='JPEGImages',
                        visibility_thresh=0.1,
+                       image_key_hash='sha256',
                        ann_json_dict=None):
     """Convert XML derived dict to tf.Example proto.
 
@@ -110,12 +243,20 @@ def dict_to_tf_example(data,
       data: dict holding PASCAL XML fields for a single image (obtained by running
         tfrecord_util.recursive_parse_xml_to_dict)
       dataset_directory: Path to root directory holding PASCAL dataset
+      filepath: Path to the annotation json file; the image is expected next to
+        it with a .jpg extension.
+      image_id: Integer id of the image.
+      camera_settings: Camera settings dict holding the captured image size.
       label_map_dict: A map from string label names to integers ids.
       ignore_difficult_instances: Whether to skip difficult instances in the
         dataset  (default: False).
       image_subdirectory: String specifying subdirectory within the PASCAL dataset
         directory holding the actual image data.
-      ann_json_dict: annotation json dictionary.
+      image_key_hash: Name of the hash stored as the image/key/<hash> feature,
+        'sha256' or 'blake3'.
+      ann_json_dict: dict with 'images' and 'annotations' lists to which the
+        image and its annotations are appended. Annotation ids are left to the
+        caller, since they must be unique across worker processes.
 
     Returns:
       example: The converted tf.Example.
@@ -125,21 +266,15 @@ def dict_to_tf_example(data,
     """
 
     img_path = filepath.split('.')[0] + '.jpg'
-    with tf.io.gfile.GFile(img_path, 'rb') as fid:
-        encoded_jpg = fid.read()
-    encoded_jpg_io = io.BytesIO(encoded_jpg)
-    image = PIL.Image.open(encoded_jpg_io)
-    if image.format != 'JPEG':
+    encoded_jpg = read_file(img_path)
+    if not encoded_jpg.startswith(_JPEG_SOI):
         raise ValueError('Image format not JPEG')
-    key = hashlib.sha256(encoded_jpg).hexdigest()
+    key = _IMAGE_KEY_HASHES[image_key_hash](encoded_jpg).hexdigest()
 
 
     width = int(camera_settings['captured_image_size']['width'])
     height = int(camera_settings['captured_image_size']['height'])
-    image_id = img_path.split('.')[0].split('/')[-1]
-    image_id = get_image_id(img_path)
-
-    if ann_json_dict:
+    if ann_json_dict is not None:
         image = {
             'file_name': img_path,
             'height': height,
@@ -148,92 +283,94 @@ def dict_to_tf_example(data,
         }
         ann_json_dict['images'].append(image)
 
-    xmin = []
-    ymin = []
-    xmax = []
-    ymax = []
-    area = []
-    classes = []
+    objects = data.get('objects', [])
+    num_objects = len(objects)
+    # Bounding box corners are stored as [row, col]; boxes holds
+    # [xmin, ymin, xmax, ymax] per object and is normalized once after the loop.
+    boxes = np.empty((num_objects, 4), dtype=np.float64)
+    classes = np.empty(num_objects, dtype=np.int64)
+    visibility = np.empty(num_objects, dtype=np.float64)
     classes_text = []
-    truncated = []
-    poses = []
-    difficult_obj = []
-    if 'objects' in data:
-        for obj in data['objects']:
-
-            difficult_obj.append(0)
-
-            xmin.append(float(obj['bounding_box']['top_left'][1]) / width)
-            ymin.append(float(obj['bounding_box']['top_left'][0]) / height)
-            xmax.append(float(obj['bounding_box']['bottom_right'][1]) / width)
-            ymax.append(float(obj['bounding_box']['bottom_right'][0]) / height)
-            area.append((xmax[-1] - xmin[-1]) * (ymax[-1] - ymin[-1]))
-            classes_text.append(obj['class'].encode('utf8'))
-            classes.append(label_map_dict[obj['class']])
-            visibility = obj['visibility']
-            truncated.append(int(visibility > visibility_thresh))
-            poses.append('Frontal'.encode('utf8'))
-
-            if ann_json_dict:
-                abs_xmin = int(obj['bounding_box']['top_left'][1])
-                abs_ymin = int(obj['bounding_box']['top_left'][0])
-                abs_xmax = int(obj['bounding_box']['bottom_right'][1])
-                abs_ymax = int(obj['bounding_box']['bottom_right'][0])
-                abs_width = abs_xmax - abs_xmin
-                abs_height = abs_ymax - abs_ymin
-                ann = {
-                    'area': abs_width * abs_height,
-                    'iscrowd': 0,
-                    'image_id': image_id,
-                    'bbox': [abs_xmin, abs_ymin, abs_width, abs_height],
-                    'category_id': label_map_dict[obj['class']],
-                    'id': get_ann_id(),
-                    'ignore': 0,
-                    'segmentation': [],
-                }
-                ann_json_dict['annotations'].append(ann)
-
-    example = tf.train.Example(
-        features=tf.train.Features(
-            feature={
-                'image/height':
-                    tfrecord_util.int64_feature(height),
-                'image/width':
-                    tfrecord_util.int64_feature(width),
-                'image/filename':
-                    tfrecord_util.bytes_feature(img_path.encode('utf8')),
-                'image/source_id':
-                    tfrecord_util.bytes_feature(str(image_id).encode('utf8')),
-                'image/key/sha256':
-                    tfrecord_util.bytes_feature(key.encode('utf8')),
-                'image/encoded':
-                    tfrecord_util.bytes_feature(encoded_jpg),
-                'image/format':
-                    tfrecord_util.bytes_feature('jpeg'.encode('utf8')),
-                'image/object/bbox/xmin':
-                    tfrecord_util.float_list_feature(xmin),
-                'image/object/bbox/xmax':
-                    tfrecord_util.float_list_feature(xmax),
-                'image/object/bbox/ymin':
-                    tfrecord_util.float_list_feature(ymin),
-                'image/object/bbox/ymax':
-                    tfrecord_util.float_list_feature(ymax),
-                'image/object/area':
-                    tfrecord_util.float_list_feature(area),
-                'image/object/class/text':
-                    tfrecord_util.bytes_list_feature(classes_text),
-                'image/object/class/label':
-                    tfrecord_util.int64_list_feature(classes),
-                'image/object/difficult':
-                    tfrecord_util.int64_list_feature(difficult_obj),
-                'image/object/truncated':
-                    tfrecord_util.int64_list_feature(truncated),
-                'image/object/view':
-                    tfrecord_util.bytes_list_feature(poses),
-            }))
+    poses = [_FRONTAL] * num_objects
+    difficult_obj = [0] * num_objects
+    for i, obj in enumerate(objects):
+        class_name = obj['class']
+        class_id = label_map_dict[class_name]
+        top_left = obj['bounding_box']['top_left']
+        bottom_right = obj['bounding_box']['bottom_right']
+        boxes[i] = (top_left[1], top_left[0], bottom_right[1], bottom_right[0])
+        classes[i] = class_id
+        visibility[i] = obj['visibility']
+        classes_text.append(class_name.encode('utf8'))
+
+        if ann_json_dict is not None:
+            abs_xmin = int(top_left[1])
+            abs_ymin = int(top_left[0])
+            abs_xmax = int(bottom_right[1])
+            abs_ymax = int(bottom_right[0])
+            abs_width = abs_xmax - abs_xmin
+            abs_height = abs_ymax - abs_ymin
+            ann = {
+                'area': abs_width * abs_height,
+                'iscrowd': 0,
+                'image_id': image_id,
+                'bbox': [abs_xmin, abs_ymin, abs_width, abs_height],
+                'category_id': class_id,
+                'ignore': 0,
+                'segmentation': [],
+            }
+            ann_json_dict['annotations'].append(ann)
+
+    boxes /= [width, height, width, height]
+    xmin, ymin, xmax, ymax = boxes.T
+    area = (xmax - xmin) * (ymax - ymin)
+    truncated = visibility > visibility_thresh
+
+    # Fill the Example's feature map in place rather than building standalone
+    # Feature messages that tf.train.Features would then copy into it.
+    example = tf.train.Example()
+    feature = example.features.feature
+    _set_int64_list(feature['image/height'], [height])
+    _set_int64_list(feature['image/width'], [width])
+    _set_bytes_list(feature['image/filename'], [img_path.encode('utf8')])
+    _set_bytes_list(feature['image/source_id'], [str(image_id).encode('utf8')])
+    _set_bytes_list(feature['image/key/' + image_key_hash],
+                    [key.encode('utf8')])
+    _set_bytes_list(feature['image/encoded'], [encoded_jpg])
+    _set_bytes_list(feature['image/format'], [_JPEG])
+    _set_float_list(feature['image/object/bbox/xmin'], xmin.tolist())
+    _set_float_list(feature['image/object/bbox/xmax'], xmax.tolist())
+    _set_float_list(feature['image/object/bbox/ymin'], ymin.tolist())
+    _set_float_list(feature['image/object/bbox/ymax'], ymax.tolist())
+    _set_float_list(feature['image/object/area'], area.tolist())
+    _set_bytes_list(feature['image/object/class/text'], classes_text)
+    _set_int64_list(feature['image/object/class/label'], classes.tolist())
+    _set_int64_list(feature['image/object/difficult'], difficult_obj)
+    _set_int64_list(feature['image/object/truncated'],
+                    truncated.astype(np.int64).tolist())
+    _set_bytes_list(feature['image/object/view'], poses)
     return example
 
 
+def _pool_create_tf_example(args):
+    """Converts one annotation file; runs in a worker process."""
+    (filepath, image_id, dataset_directory, camera_settings, label_map_dict,
+     ignore_difficult_instances, image_key_hash) = args
+    annotation = _loads(read_file(filepath))
+    ann_json_dict = {'images': [], 'annotations': []}
+    tf_example = dict_to_tf_example(
+        annotation,
+        dataset_directory,
+        filepath,
+        image_id,
+        camera_settings,
+        label_map_dict,
+        ignore_difficult_instances,
+        image_key_hash=image_key_hash,
+        ann_json_dict=ann_json_dict)
+    return tf_example.SerializeToString(), ann_json_dict
+
+
 def main(_):
     if FLAGS.set not in SETS:
         raise ValueError('set must be in : {}'.format(SETS))
@@ -241,6 +378,9 @@ def main(_):
         raise ValueError('year must be in : {}'.format(YEARS))
     if not FLAGS.output_path:
         raise ValueError('output_path cannot be empty.')
+    if FLAGS.image_key_hash not in _IMAGE_KEY_HASHES:
+        raise ValueError('image_key_hash={} requires the {} package.'.format(
+            FLAGS.image_key_hash, FLAGS.image_key_hash))
 
     data_dir = FLAGS.data_dir
     years = ['ESM2020', 'ESM']
@@ -252,73 +392,82 @@ def main(_):
         tf.io.gfile.makedirs(output_dir)
     logging.info('Writing to output directory: %s', output_dir)
 
-    writers = [
-        tf.io.TFRecordWriter(FLAGS.output_path + '-%05d-of-%05d.tfrecord' %
-                             (i, FLAGS.num_shards))
-        for i in range(FLAGS.num_shards)
-    ]
+    options = None
+    if FLAGS.compression_type:
+        options = tf.io.TFRecordOptions(
+            compression_type=FLAGS.compression_type,
+            compression_level=FLAGS.compression_level)
 
     if FLAGS.label_map_json_path:
-        with tf.io.gfile.GFile(FLAGS.label_map_json_path, 'rb') as f:
-            labels = json.load(f)
-            labels = labels['exported_object_classes']
+        labels = _loads(read_file(FLAGS.label_map_json_path))
+        labels = labels['exported_object_classes']
 
-            label_map_dict = {'background': 0}
-            for idx, label in enumerate(labels):
-                label_map_dict[label] = idx+1
+        label_map_dict = {'background': 0}
+        for idx, label in enumerate(labels):
+            label_map_dict[label] = idx+1
     else:
         label_map_dict = esm_label_map_dict
 
     camera_settings = {}
     if FLAGS.camera_settings_json_path:
-        with tf.io.gfile.GFile(FLAGS.camera_settings_json_path, 'rb') as f:
-            labels = json.load(f)
-            camera_settings = labels['camera_settings'][0]
-
-    ann_json_dict = {
-        'images': [],
-        'type': 'instances',
-        'annotations': [],
-        'categories': []
-    }
-    for year in years:
-        example_class = list(label_map_dict.keys())[1]
-
-        curr_idx = 0
-        for entry in sorted(os.scandir(os.path.join(data_dir, year)), key=lambda e: e.name):
-            if entry.name.endswith('.json'):
-                with tf.io.gfile.GFile(entry.path, 'rb') as f:
-                    annotation = json.load(f)
-
-                    for class_name, class_id in label_map_dict.items():
-                        cls = {'supercategory': 'none', 'id': class_id, 'name': class_name}
-                        ann_json_dict['categories'].append(cls)
-
-                    if FLAGS.num_images and curr_idx >= FLAGS.num_images:
-                        break
-                    if curr_idx % 100 == 0:
-                        logging.info('On image %d', curr_idx)
-
-                    tf_example = dict_to_tf_example(
-                        annotation,
-                        FLAGS.data_dir,
-                        entry.path,
-                        camera_settings,
-                        label_map_dict,
-                        FLAGS.ignore_difficult_instances,
-                        ann_json_dict=ann_json_dict)
-                    writers[curr_idx % FLAGS.num_shards].write(tf_example.SerializeToString())
-
-                    curr_idx += 1
-
-    for writer in writers:
-        writer.close()
+        labels = _loads(read_file(FLAGS.camera_settings_json_path))
+        camera_settings = labels['camera_settings'][0]
 
     json_file_path = os.path.join(
         os.path.dirname(FLAGS.output_path),
         'json_' + os.path.basename(FLAGS.output_path) + '.json')
-    with tf.io.gfile.GFile(json_file_path, 'w') as f:
-        json.dump(ann_json_dict, f)
+    categories = [
+        {'supercategory': 'none', 'id': class_id, 'name': class_name}
+        for class_name, class_id in label_map_dict.items()
+    ]
+
+    # The exit stack terminates the pool, finishes (or, on error, discards) the
+    # json and closes the TFRecord writers, in that order.
+    with contextlib.ExitStack() as exit_stack:
+        writers = [
+            exit_stack.enter_context(
+                tf.io.TFRecordWriter(
+                    FLAGS.output_path + '-%05d-of-%05d.tfrecord' %
+                    (i, FLAGS.num_shards), options=options))
+            for i in range(FLAGS.num_shards)
+        ]
+        ann_json_writer = exit_stack.enter_context(
+            CocoJsonWriter(json_file_path, categories))
+        pool = exit_stack.enter_context(
+            multiprocessing.Pool(FLAGS.num_threads))
+        for year in years:
+            # Only sort the annotation files, and only as many as are needed.
+            entries = [
+                entry for entry in os.scandir(os.path.join(data_dir, year))
+                if entry.name.endswith('.json')
+            ]
+            if FLAGS.num_images:
+                entries = heapq.nsmallest(
+                    FLAGS.num_images, entries, key=lambda e: e.name)
+            else:
+                entries.sort(key=lambda e: e.name)
+            entries = [entry.path for entry in entries]
+
+            # Ids are handed out here so that they stay sequential regardless of
+            # which worker converts the image.
+            for curr_idx, (serialized_example, ann_json_dict) in enumerate(
+                    pool.imap(
+                        _pool_create_tf_example,
+                        [(filepath, get_image_id(filepath), data_dir,
+                          camera_settings, label_map_dict,
+                          FLAGS.ignore_difficult_instances,
+                          FLAGS.image_key_hash)
+                         for filepath in entries],
+                        chunksize=32)):
+                if curr_idx % 100 == 0:
+                    logging.info('On image %d of %d', curr_idx, len(entries))
+
+                writers[curr_idx % FLAGS.num_shards].write(serialized_example)
+                for image in ann_json_dict['images']:
+                    ann_json_writer.add_image(image)
+                for ann in ann_json_dict['annotations']:
+                    ann['id'] = get_ann_id()
+                    ann_json_writer.add_annotation(ann)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,206 @@
+# Copyright 2020 Google Research. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Test for create_synth_DR_tfrecord.py."""
+
+import hashlib
+import json
+import os
+
+from absl import logging
+import numpy as np
+import PIL.Image
+import six
+import tensorflow as tf
+
+from dataset import create_synth_DR_tfrecord
+
+
+class CreateSynthDRTFRecordTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(CreateSynthDRTFRecordTest, self).setUp()
+    self.camera_settings = {'captured_image_size': {'width': 64, 'height': 32}}
+    self.label_map_dict = {'background': 0, 'Hat': 1, 'Mask': 2}
+    self.categories = [{'supercategory': 'none', 'id': 1, 'name': 'Hat'}]
+    tmp_dir = self.get_temp_dir()
+    self.filepath = os.path.join(tmp_dir, '000000.json')
+    image_data = np.random.randint(0, 256, (32, 64, 3), dtype=np.uint8)
+    image = PIL.Image.fromarray(image_data)
+    image.save(os.path.join(tmp_dir, '000000.jpg'))
+
+  def _assertProtoEqual(self, proto_field, expectation):
+    """Helper function to assert if a proto field equals some value.
+
+    Args:
+      proto_field: The protobuf field to compare.
+      expectation: The expected value of the protobuf field.
+    """
+    proto_list = [p for p in proto_field]
+    self.assertListEqual(proto_list, expectation)
+
+  def _write_json(self, path, images, annotations):
+    with create_synth_DR_tfrecord.CocoJsonWriter(path,
+                                                 self.categories) as writer:
+      for image in images:
+        writer.add_image(image)
+      for ann in annotations:
+        writer.add_annotation(ann)
+    with open(path) as f:
+      return json.loads(f.read())
+
+  def test_dict_to_tf_example(self):
+    data = {
+        'objects': [{
+            'class': 'Mask',
+            'visibility': 0.5,
+            'bounding_box': {
+                'top_left': [8, 16],
+                'bottom_right': [24, 48]
+            },
+        }]
+    }
+    ann_json_dict = {'images': [], 'annotations': []}
+    example = create_synth_DR_tfrecord.dict_to_tf_example(
+        data,
+        self.get_temp_dir(),
+        self.filepath,
+        7,
+        self.camera_settings,
+        self.label_map_dict,
+        ann_json_dict=ann_json_dict)
+
+    feature = example.features.feature
+    self._assertProtoEqual(feature['image/height'].int64_list.value, [32])
+    self._assertProtoEqual(feature['image/width'].int64_list.value, [64])
+    self._assertProtoEqual(feature['image/source_id'].bytes_list.value,
+                           [six.b('7')])
+    self._assertProtoEqual(feature['image/format'].bytes_list.value,
+                           [six.b('jpeg')])
+    self._assertProtoEqual(feature['image/object/bbox/xmin'].float_list.value,
+                           [0.25])
+    self._assertProtoEqual(feature['image/object/bbox/ymin'].float_list.value,
+                           [0.25])
+    self._assertProtoEqual(feature['image/object/bbox/xmax'].float_list.value,
+                           [0.75])
+    self._assertProtoEqual(feature['image/object/bbox/ymax'].float_list.value,
+                           [0.75])
+    self._assertProtoEqual(feature['image/object/area'].float_list.value,
+                           [0.25])
+    self._assertProtoEqual(feature['image/object/class/text'].bytes_list.value,
+                           [six.b('Mask')])
+    self._assertProtoEqual(feature['image/object/class/label'].int64_list.value,
+                           [2])
+    self._assertProtoEqual(feature['image/object/truncated'].int64_list.value,
+                           [1])
+
+    self.assertLen(ann_json_dict['images'], 1)
+    self.assertEqual(ann_json_dict['images'][0]['id'], 7)
+    self.assertLen(ann_json_dict['annotations'], 1)
+    ann = ann_json_dict['annotations'][0]
+    self.assertEqual(ann['bbox'], [16, 8, 32, 16])
+    self.assertEqual(ann['area'], 32 * 16)
+    self.assertEqual(ann['category_id'], 2)
+
+  def test_dict_to_tf_example_image_key(self):
+    with open(os.path.join(self.get_temp_dir(), '000000.jpg'), 'rb') as f:
+      encoded_jpg = f.read()
+    example = create_synth_DR_tfrecord.dict_to_tf_example(
+        {}, self.get_temp_dir(), self.filepath, 1, self.camera_settings,
+        self.label_map_dict)
+    self._assertProtoEqual(
+        example.features.feature['image/key/sha256'].bytes_list.value,
+        [six.b(hashlib.sha256(encoded_jpg).hexdigest())])
+
+    try:
+      import blake3  # pylint: disable=g-import-not-at-top,unused-import
+    except ImportError:
+      return
+    example = create_synth_DR_tfrecord.dict_to_tf_example(
+        {}, self.get_temp_dir(), self.filepath, 1, self.camera_settings,
+        self.label_map_dict, image_key_hash='blake3')
+    self.assertNotIn('image/key/sha256', example.features.feature)
+    self.assertLen(
+        example.features.feature['image/key/blake3'].bytes_list.value, 1)
+
+  def test_dict_to_tf_example_without_objects(self):
+    ann_json_dict = {'images': [], 'annotations': []}
+    example = create_synth_DR_tfrecord.dict_to_tf_example(
+        {},
+        self.get_temp_dir(),
+        self.filepath,
+        1,
+        self.camera_settings,
+        self.label_map_dict,
+        ann_json_dict=ann_json_dict)
+
+    feature = example.features.feature
+    self._assertProtoEqual(feature['image/object/bbox/xmin'].float_list.value,
+                           [])
+    self._assertProtoEqual(feature['image/object/class/label'].int64_list.value,
+                           [])
+    self.assertLen(ann_json_dict['images'], 1)
+    self.assertEmpty(ann_json_dict['annotations'])
+
+  def test_read_file(self):
+    path = os.path.join(self.get_temp_dir(), 'read_file.json')
+    with open(path, 'wb') as f:
+      f.write(b'{}')
+    self.assertEqual(create_synth_DR_tfrecord.read_file(path), b'{}')
+    self.assertEqual(create_synth_DR_tfrecord.read_file('file://' + path),
+                     b'{}')
+
+    ram_path = 'ram://read_file.json'
+    with tf.io.gfile.GFile(ram_path, 'wb') as f:
+      f.write(b'[]')
+    self.assertEqual(create_synth_DR_tfrecord.read_file(ram_path), b'[]')
+
+  def test_coco_json_writer(self):
+    path = os.path.join(self.get_temp_dir(), 'json_all.json')
+    images = [{'id': 1}, {'id': 2}]
+    annotations = [{'id': 1, 'image_id': 1}, {'id': 2, 'image_id': 2}]
+    ann_json = self._write_json(path, images, annotations)
+    self.assertEqual(ann_json['type'], 'instances')
+    self.assertEqual(ann_json['categories'], self.categories)
+    self.assertEqual(ann_json['images'], images)
+    self.assertEqual(ann_json['annotations'], annotations)
+    self.assertFalse(os.path.exists(path + '.incomplete'))
+
+  def test_coco_json_writer_without_images(self):
+    path = os.path.join(self.get_temp_dir(), 'json_empty.json')
+    ann_json = self._write_json(path, [], [])
+    self.assertEqual(ann_json['categories'], self.categories)
+    self.assertEqual(ann_json['images'], [])
+    self.assertEqual(ann_json['annotations'], [])
+
+  def test_coco_json_writer_without_annotations(self):
+    path = os.path.join(self.get_temp_dir(), 'json_no_ann.json')
+    ann_json = self._write_json(path, [{'id': 1}], [])
+    self.assertEqual(ann_json['images'], [{'id': 1}])
+    self.assertEqual(ann_json['annotations'], [])
+
+  def test_coco_json_writer_discards_output_on_error(self):
+    path = os.path.join(self.get_temp_dir(), 'json_error.json')
+    with self.assertRaises(KeyError):
+      with create_synth_DR_tfrecord.CocoJsonWriter(path,
+                                                   self.categories) as writer:
+        writer.add_image({'id': 1})
+        raise KeyError('unknown class')
+    self.assertFalse(os.path.exists(path))
+    self.assertFalse(os.path.exists(path + '.incomplete'))
+
+
+if __name__ == '__main__':
+  logging.set_verbosity(logging.WARNING)
+  tf.test.main()